@@ -1,30 +1,50 @@
 #!/usr/bin/env python3
 """
 剪贴板朗读工具 (Low Latency Edition)
-快捷键: Alt+C
+快捷键: Alt+C (可用 CLIPSPEAK_HOTKEY 覆盖)
 - 极速启动：零缓冲播放参数
 - 性能监控：精确记录首响延迟
 """
 
 import threading
+import ctypes
 import subprocess
 import gc
 import sys
 import os
-import datetime
-import socket
-import queue
+import tempfile
 import traceback
 import asyncio
 import time
 import re
+import random
+import math
 import platform
 
-import edge_tts
+if sys.platform == "win32":
+    import msvcrt
+else:
+    import fcntl
+
 import keyboard
 import pyperclip
 
 
+_log_clock = (None, "") # (整秒, 格式化后的 时:分:秒)
+
+
+def log(msg, level="INFO"):
+    """带时间戳的日志输出 (时分秒按整秒缓存，只补毫秒)"""
+    global _log_clock
+    now = time.time()
+    second = int(now)
+    clock = _log_clock
+    if clock[0] != second:
+        clock = (second, time.strftime("%H:%M:%S", time.localtime(second)))
+        _log_clock = clock
+    print(f"[{clock[1]}.{int((now - second) * 1000):03d}] [{level}] {msg}")
+
+
 def get_ffplay_path():
     """获取 ffplay 路径"""
     if getattr(sys, 'frozen', False):
@@ -34,75 +54,275 @@ def get_ffplay_path():
         return "ffplay"
 
 
+def build_atempo_filter(speed):
+    """ffmpeg 的 atempo 单级只支持 0.5~2.0 倍，超出部分拆成多级串联"""
+    # 0、负数、inf/nan 会让下面的循环永不结束
+    if not (math.isfinite(speed) and speed > 0):
+        raise ValueError(f"无效的播放倍速: {speed}")
+    stages = []
+    while speed > 2.0:
+        stages.append("atempo=2.0")
+        speed /= 2.0
+    while speed < 0.5:
+        stages.append("atempo=0.5")
+        speed /= 0.5
+    stages.append(f"atempo={speed}")
+    return ",".join(stages)
+
+
+RE_RATE = re.compile(r'[+-]\d+%') # edge-tts 接受的语速格式，如 +100%
+
+
+SPEED_MIN = 0.25 # 倍速允许范围：过大的值会生成上百级的 atempo 串联
+SPEED_MAX = 8.0
+
+
+def env_speed(name, default):
+    """读取倍速环境变量；非数字或超出 SPEED_MIN~SPEED_MAX (含 nan/inf) 时记日志后回退默认值"""
+    raw = os.environ.get(name)
+    if raw is None:
+        return default
+    try:
+        speed = float(raw)
+        if not SPEED_MIN <= speed <= SPEED_MAX:
+            raise ValueError(speed)
+        return speed
+    except ValueError:
+        log(f"环境变量 {name}={raw!r} 无效 (应在 {SPEED_MIN}~{SPEED_MAX} 之间)，使用默认值 {default}", "WARN")
+        return default
+
+
+def env_rate(name, default):
+    """读取语速环境变量；格式不对时 edge-tts 会在每段下载时报错，这里提前回退默认值"""
+    raw = os.environ.get(name)
+    if raw is None:
+        return default
+    if RE_RATE.fullmatch(raw):
+        return raw
+    log(f"环境变量 {name}={raw!r} 无效 (应形如 +50% / -10%)，使用默认值 {default}", "WARN")
+    return default
+
+
 # --- 核心配置 ---
+# 快捷键/语速可用环境变量覆盖，无需改代码
+DEFAULT_HOTKEY = "alt+c"
+HOTKEY = os.environ.get("CLIPSPEAK_HOTKEY", DEFAULT_HOTKEY) # 合法性在 main() 注册时校验
 VOICE = "zh-CN-XiaoxiaoNeural"
-RATE = "+100%"  
-SPEED = 1.5     
+RATE = env_rate("CLIPSPEAK_RATE", "+100%")
+SPEED = env_speed("CLIPSPEAK_SPEED", 1.5)
+ATEMPO_FILTER = build_atempo_filter(SPEED)
+FFPLAY_PATH = get_ffplay_path()
 CHUNK_MIN_SIZE = 300
 CHUNK_MAX_SIZE = 800
 HARD_LIMIT_SIZE = 1000
-
-lock = threading.Lock()
-is_playing = False
+AUDIO_BUFFER_SIZE = 1 << 20 # 生产者/消费者之间的音频缓冲 (1MB)
+PENDING_TARGET = 16384      # 生产者合并小包的目标大小
+PIPE_BUFFER_SIZE = 1 << 20  # ffplay stdin 管道的内核缓冲 (1MB)
+PREFETCH_SEGMENTS = 2       # 同时在途的分段数 (播放中的一段 + 预取的下一段)
+RETRY_BASE_DELAY = 0.5      # 重试退避基数 (秒)
+RETRY_MAX_DELAY = 8.0       # 重试退避上限 (秒)
+RECEIVE_IDLE_TIMEOUT = 10   # 收流中途多久无数据判定为卡死 (秒)
+TTS_HOST = "speech.platform.bing.com"
+DEBUG = bool(os.environ.get("CLIPSPEAK_DEBUG")) # 开启后每次朗读结束做完整 GC 排查
+HAS_WRITEV = hasattr(os, "writev") # Windows 没有 writev
+
+# === 极速启动参数 (启动时固定，每次朗读直接复用) ===
+# -f mp3: edge-tts 固定输出 MP3，跳过格式探测
+# -probesize 32 / -analyzeduration 0: 格式已知，几乎不用预读即可开始解码
+# -fflags nobuffer: 禁用输入缓冲 (探测阶段读到的包会被丢弃，所以 probesize 必须极小，
+#                   4096 时开头约 0.7 秒语音会被吞掉)
+# -flags low_delay: 启用低延迟模式
+FFPLAY_ARGV = (
+    FFPLAY_PATH, "-nodisp", "-autoexit",
+    "-f", "mp3",
+    "-probesize", "32", "-analyzeduration", "0",
+    "-fflags", "nobuffer",
+    "-flags", "low_delay",
+    "-i", "pipe:0",
+    "-af", ATEMPO_FILTER,
+    "-loglevel", "error",
+)
+if sys.platform == "win32":
+    # close_fds=False 省去逐个枚举句柄；我们的管道句柄本身不可继承，不会泄漏给 ffplay
+    FFPLAY_POPEN_KWARGS = {"creationflags": subprocess.CREATE_NO_WINDOW, "close_fds": False}
+else:
+    # POSIX 上必须保持 close_fds=True，否则 ffplay 会继承管道写端而永远等不到 EOF
+    FFPLAY_POPEN_KWARGS = {}
+
+lock = threading.Lock() # 仅保护 ffplay_process / active_queue 句柄的交换
+stop_event = threading.Event() # 置位 = 空闲/已停止，热路径只读不加锁
+stop_event.set()
 ffplay_process = None
+active_queue = None # 当前会话的音频缓冲，停止时中止它以唤醒消费者
+ffplay_job = None # Windows: 承载 ffplay 的 Job Object
+tts_loop = None   # 常驻的 asyncio 事件循环 (后台线程)
 start_press_time = None # 记录按下快捷键的时间
+last_split = (None, None) # 上次朗读的 (剪贴板文本, 分块结果)
+edge_tts = None   # 延迟导入 (连带 aiohttp 等，约 200ms+)，见 load_edge_tts
+
+# --- Win32 API ---
+ERROR_ALREADY_EXISTS = 183
+SINGLETON_MUTEX = "Global\\ClipSpeakSingleton"
+
+if sys.platform == "win32":
+    kernel32 = ctypes.WinDLL("kernel32", use_last_error=True)
+    kernel32.CreateMutexW.restype = ctypes.c_void_p
+    kernel32.CreateMutexW.argtypes = [ctypes.c_void_p, ctypes.c_int, ctypes.c_wchar_p]
+    kernel32.CreateJobObjectW.restype = ctypes.c_void_p
+    kernel32.SetInformationJobObject.argtypes = [
+        ctypes.c_void_p, ctypes.c_int, ctypes.c_void_p, ctypes.c_uint32
+    ]
+    kernel32.AssignProcessToJobObject.argtypes = [ctypes.c_void_p, ctypes.c_void_p]
+    kernel32.TerminateJobObject.argtypes = [ctypes.c_void_p, ctypes.c_uint]
+    kernel32.CloseHandle.argtypes = [ctypes.c_void_p]
+    kernel32.CreatePipe.argtypes = [
+        ctypes.POINTER(ctypes.c_void_p), ctypes.POINTER(ctypes.c_void_p),
+        ctypes.c_void_p, ctypes.c_uint32
+    ]
+else:
+    kernel32 = None
 
 RE_SPLIT = re.compile(r'([。！？；!?;])')
 
 
-def log(msg, level="INFO"):
-    """带时间戳的日志输出"""
-    timestamp = datetime.datetime.now().strftime("%H:%M:%S.%f")[:-3]
-    print(f"[{timestamp}] [{level}] {msg}")
-
-
 def log_memory_stats():
-    """内存健康度检查"""
-    gc.collect()
-    obj_count = len(gc.get_objects())
-    log(f"内存快照: 对象数 {obj_count} | GC: {gc.get_stats()}", "MEM")
+    """内存健康度检查 (只读计数，不触发全量回收)；调试模式下才做完整回收排查泄漏"""
+    if DEBUG:
+        collected = gc.collect()
+        log(f"调试回收: 释放 {collected} 个对象 | 存活 {len(gc.get_objects())} 个", "MEM")
+    log(f"内存快照: 分代计数 {gc.get_count()} | GC: {gc.get_stats()}", "MEM")
 
 
 def check_singleton():
-    """单例检查"""
+    """单例检查 (Windows 命名互斥量 / 其他平台文件锁)，返回值需持有到进程退出"""
+    if kernel32:
+        handle = kernel32.CreateMutexW(None, True, SINGLETON_MUTEX)
+        if not handle:
+            return None
+        if ctypes.get_last_error() == ERROR_ALREADY_EXISTS:
+            kernel32.CloseHandle(handle)
+            return None
+        return handle
+
+    # 共享的 /tmp 里锁文件可能属于其他用户，open 本身也会失败
+    lock_file = None
     try:
-        lock_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        lock_socket.bind(('127.0.0.1', 45678)) 
-        return lock_socket
-    except socket.error:
+        lock_file = open(os.path.join(tempfile.gettempdir(), "clipspeak.lock"), "w")
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        if lock_file:
+            lock_file.close()
         return None
+    return lock_file
+
+
+# --- Win32 Job Object: 播放器进程随 Job 一起结束 ---
+JOB_OBJECT_LIMIT_KILL_ON_JOB_CLOSE = 0x2000
+JOB_OBJECT_EXTENDED_LIMIT_INFORMATION_CLASS = 9
+
+
+class JOBOBJECT_BASIC_LIMIT_INFORMATION(ctypes.Structure):
+    _fields_ = [
+        ("PerProcessUserTimeLimit", ctypes.c_int64),
+        ("PerJobUserTimeLimit", ctypes.c_int64),
+        ("LimitFlags", ctypes.c_uint32),
+        ("MinimumWorkingSetSize", ctypes.c_size_t),
+        ("MaximumWorkingSetSize", ctypes.c_size_t),
+        ("ActiveProcessLimit", ctypes.c_uint32),
+        ("Affinity", ctypes.c_size_t),
+        ("PriorityClass", ctypes.c_uint32),
+        ("SchedulingClass", ctypes.c_uint32),
+    ]
+
+
+class IO_COUNTERS(ctypes.Structure):
+    _fields_ = [(name, ctypes.c_uint64) for name in (
+        "ReadOperationCount", "WriteOperationCount", "OtherOperationCount",
+        "ReadTransferCount", "WriteTransferCount", "OtherTransferCount",
+    )]
+
+
+class JOBOBJECT_EXTENDED_LIMIT_INFORMATION(ctypes.Structure):
+    _fields_ = [
+        ("BasicLimitInformation", JOBOBJECT_BASIC_LIMIT_INFORMATION),
+        ("IoInfo", IO_COUNTERS),
+        ("ProcessMemoryLimit", ctypes.c_size_t),
+        ("JobMemoryLimit", ctypes.c_size_t),
+        ("PeakProcessMemoryUsed", ctypes.c_size_t),
+        ("PeakJobMemoryUsed", ctypes.c_size_t),
+    ]
+
+
+def create_ffplay_job():
+    """创建 KILL_ON_JOB_CLOSE 的 Job Object (仅 Windows)，失败返回 None"""
+    if not kernel32:
+        return None
+
+    job = kernel32.CreateJobObjectW(None, None)
+    if not job:
+        log(f"创建 Job Object 失败 (err={ctypes.get_last_error()})", "WARN")
+        return None
+
+    info = JOBOBJECT_EXTENDED_LIMIT_INFORMATION()
+    info.BasicLimitInformation.LimitFlags = JOB_OBJECT_LIMIT_KILL_ON_JOB_CLOSE
+    if not kernel32.SetInformationJobObject(
+        job, JOB_OBJECT_EXTENDED_LIMIT_INFORMATION_CLASS,
+        ctypes.byref(info), ctypes.sizeof(info)
+    ):
+        log(f"设置 Job Object 失败 (err={ctypes.get_last_error()})", "WARN")
+        kernel32.CloseHandle(job)
+        return None
+    return job
+
+
+def assign_to_ffplay_job(proc):
+    """将播放器进程挂入 Job"""
+    if not ffplay_job:
+        return
+    if not kernel32.AssignProcessToJobObject(ffplay_job, int(proc._handle)):
+        log(f"进程加入 Job 失败 (err={ctypes.get_last_error()})", "WARN")
+
+
+def terminate_ffplay_job():
+    """结束 Job 内的全部播放器进程 (只影响本程序启动的 ffplay)"""
+    if not ffplay_job:
+        return
+    kernel32.TerminateJobObject(ffplay_job, 1)
 
 
 def stop_playback(clear_flags=True):
     """停止播放并执行深度清理"""
-    global is_playing, ffplay_process
+    global ffplay_process, active_queue
     
+    if clear_flags:
+        if not stop_event.is_set():
+            log("状态机变更: Running -> Stopped", "STATE")
+        stop_event.set()
     with lock:
-        if clear_flags:
-            if is_playing:
-                log("状态机变更: Running -> Stopped", "STATE")
-            is_playing = False
         proc = ffplay_process
         ffplay_process = None
+        data_queue = active_queue
+        active_queue = None
+    
+    if data_queue:
+        data_queue.abort()
     
     if proc:
+        # stdin 由消费者线程关闭：它可能正阻塞在 os.write 上，
+        # 跨线程关闭 fd 后该编号可能被复用，这里只结束进程让写入报错退出
         log(f"终止播放器进程 (PID: {proc.pid})", "CLEAN")
-        try:
-            proc.stdin.close()
-        except: pass
         try:
             proc.terminate()
             proc.wait(timeout=1)
         except:
             try:
                 proc.kill()
+                proc.wait(timeout=0.2)
             except: pass
-    
-    if sys.platform == "win32":
-        try:
-            subprocess.run(["taskkill", "/F", "/IM", "ffplay.exe"], 
-                         stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-        except: pass
+        
+        # 兜底：terminate/kill 都没能结束进程时才动用 Job 整体结束
+        if proc.poll() is None:
+            terminate_ffplay_job()
 
 
 def split_text_smart_v3(text):
@@ -154,112 +374,450 @@ def split_text_smart_v3(text):
     return chunks
 
 
-def audio_producer(text_chunks, data_queue):
-    """生产者 (完整日志版)"""
-    global is_playing
-    total_chunks = len(text_chunks)
-    log(f"下载线程启动 (任务队列: {total_chunks})", "NET")
-    
+STOP_SENTINEL = object() # 缓冲区被中止时 peek() 的返回值
+
+
+class SPSCBytesRing:
+    """单生产者/单消费者字节环形缓冲区
+
+    head 只由消费者推进，tail 只由生产者推进 (均为累计字节数)；
+    GIL 下 int 赋值是原子的，读写路径不加锁，Event 仅在空/满时用于休眠唤醒。
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.buf = bytearray(capacity)
+        self.view = memoryview(self.buf)
+        self.head = 0
+        self.tail = 0
+        self.producer_done = threading.Event()
+        self.aborted = False
+        self._readable = threading.Event()
+        self._writable = threading.Event()
+
+    def put_nowait(self, parts):
+        """写入一组数据块 (整体可见)；空间不足立即返回 False"""
+        n = sum(map(len, parts))
+        if self.capacity - (self.tail - self.head) < n:
+            return False
+        self._write(parts, n)
+        return True
+
+    def put(self, parts):
+        """写入一组数据块 (整体可见)；空间不足时阻塞等待，已中止返回 False"""
+        n = sum(map(len, parts))
+        if n > self.capacity:
+            raise ValueError(f"数据块过大 ({n} > {self.capacity})")
+        while self.capacity - (self.tail - self.head) < n:
+            if self.aborted:
+                return False
+            # 先清再查，避免与消费者的 set 交错丢失唤醒
+            self._writable.clear()
+            if self.capacity - (self.tail - self.head) >= n or self.aborted:
+                continue
+            self._writable.wait()
+        self._write(parts, n)
+        return True
+
+    def _write(self, parts, n):
+        # 各数据块直接拷入环形区，不先拼成一整块
+        pos = self.tail % self.capacity
+        for part in parts:
+            size = len(part)
+            first = min(size, self.capacity - pos)
+            if first == size:
+                self.view[pos:pos + size] = part
+            else:
+                part = memoryview(part)
+                self.view[pos:] = part[:first]
+                self.view[:size - first] = part[first:]
+            pos = (pos + size) % self.capacity
+        self.tail += n
+
+        if not self._readable.is_set():
+            self._readable.set()
+
+    def peek(self):
+        """阻塞借出当前全部可读数据 (1~2 段 memoryview，零拷贝)，用完须 release
+
+        生产者结束且已读空返回 None，被中止返回 STOP_SENTINEL
+        """
+        while True:
+            if self.aborted:
+                return STOP_SENTINEL
+            tail = self.tail
+            if tail != self.head:
+                break
+            if self.producer_done.is_set():
+                # done 之前的写入必然已反映到 tail，再确认一次即可
+                if self.tail == self.head:
+                    return None
+                continue
+            self._readable.clear()
+            if self.tail != self.head or self.producer_done.is_set() or self.aborted:
+                continue
+            self._readable.wait()
+
+        # release 之前 head 不动，生产者不会覆盖借出的区域
+        n = tail - self.head
+        pos = self.head % self.capacity
+        first = min(n, self.capacity - pos)
+        if first < n:
+            return (self.view[pos:pos + first], self.view[:n - first])
+        return (self.view[pos:pos + n],)
+
+    def release(self, n):
+        """归还 peek 借出的前 n 字节，腾出空间给生产者"""
+        self.head += n
+        if not self._writable.is_set():
+            self._writable.set()
+
+    def close(self):
+        """生产者结束标记 (取代 None 哨兵)"""
+        self.producer_done.set()
+        self._readable.set()
+
+    def abort(self):
+        """中止：立即唤醒两端 (停止播放 / 播放器退出时调用)"""
+        self.aborted = True
+        self._readable.set()
+        self._writable.set()
+
+    def clear(self):
+        """丢弃未读数据 (仅消费者调用)"""
+        self.head = self.tail
+        self._writable.set()
+
+
+def retry_delay(attempt):
+    """指数退避 + 随机抖动，避免被限流时集中重试"""
+    return min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt) * random.uniform(0.7, 1.3)
+
+
+def start_tts_loop():
+    """启动常驻事件循环线程，所有 TTS 下载协程共用，不再每次朗读新建/销毁"""
     loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
-    
+    threading.Thread(target=loop.run_forever, name="tts-loop", daemon=True).start()
+    return loop
+
+
+def stop_tts_loop(loop):
+    """退出时收尾：异步生成器最多给 100ms 关闭，不在退出路径上长时间等待"""
+    async def _shutdown():
+        try:
+            await asyncio.wait_for(loop.shutdown_asyncgens(), 0.1)
+        except asyncio.TimeoutError:
+            pass
+
     try:
-        for i, chunk_text in enumerate(text_chunks):
-            with lock:
-                if not is_playing: break
-            
-            max_retries = 3
-            for attempt in range(max_retries):
-                try:
-                    start_time = time.time()
-                    log(f"-> 开始下载第 {i+1}/{total_chunks} 段 ({len(chunk_text)} 字符)...", "NET")
-                    
-                    conn_start_time = time.time() # 记录连接开始时间
-                    
-                    communicate = edge_tts.Communicate(chunk_text, VOICE, rate=RATE)
-                    async_gen = communicate.stream()
-                    iterator = async_gen.__aiter__()
-                    
-                    chunk_size_total = 0
-                    is_first_chunk = True # 标记是否为首包
-                    
-                    while True:
-                        with lock:
-                            if not is_playing: break
-                        
-                        try:
-                            # 10s 超时
-                            chunk = loop.run_until_complete(
-                                asyncio.wait_for(iterator.__anext__(), timeout=10)
-                            )
-                            
-                            # 记录首包到达时间 (TTFB)
-                            if is_first_chunk:
-                                ttfb = time.time() - conn_start_time
-                                log(f"微软服务器已响应 (首包耗时/TTFB: {ttfb:.2f}s)", "NET")
-                                is_first_chunk = False
-                            
-                            if chunk["type"] == "audio":
-                                while is_playing:
-                                    try:
-                                        data_queue.put(chunk["data"], timeout=1)
-                                        chunk_size_total += len(chunk["data"])
-                                        break
-                                    except queue.Full:
-                                        continue
-                            elif chunk["type"] == "error":
-                                raise Exception(f"TTS Error: {chunk['message']}")
-                                
-                        except StopAsyncIteration:
-                            break
-                        except asyncio.TimeoutError:
-                            raise Exception("Network Timeout (10s)")
-                    
-                    duration = time.time() - start_time
-                    log(f"<- 第 {i+1} 段下载完成 ({chunk_size_total/1024:.1f} KB, 耗时 {duration:.2f}s)", "NET")
-                    break 
-                    
-                except Exception as e:
-                    with lock:
-                        if not is_playing: break
-                    
-                    if attempt < max_retries - 1:
-                        log(f"!! 网络连接失败: {e}. 1s后重试 ({attempt+1}/{max_retries})", "WARN")
-                        time.sleep(1.0)
-                    else:
-                        log(f"!! 第 {i+1} 段下载最终失败: {e}", "ERR")
-            
+        asyncio.run_coroutine_threadsafe(_shutdown(), loop).result(timeout=0.5)
+    except Exception:
+        pass
+    loop.call_soon_threadsafe(loop.stop)
+
+
+def load_edge_tts():
+    """按需导入 edge_tts；启动时排在 TTS 循环的第一个回调里预热，不拖慢启动"""
+    global edge_tts
+    if edge_tts is None:
+        import edge_tts as module
+        edge_tts = module
+    return edge_tts
+
+
+def warm_up_edge_tts():
+    """启动时预热导入；失败直接报 FATAL，不要等到每段下载时才反复重试"""
+    try:
+        load_edge_tts()
     except Exception as e:
-        log(f"生产者线程崩溃: {e}", "FATAL")
+        log(f"edge_tts 导入失败，无法朗读: {e}", "FATAL")
         traceback.print_exc()
+
+
+async def warm_up_dns():
+    """启动时预解析 TTS 服务域名，首次朗读免去 DNS 查询"""
+    try:
+        await asyncio.get_running_loop().getaddrinfo(TTS_HOST, 443)
+    except OSError as e:
+        log(f"DNS 预热失败: {e}", "WARN")
+
+
+async def _queue_put_async(data_queue, parts):
+    """快路径直接写入；缓冲区满时才转到线程池阻塞等待 (停止播放会中止队列并唤醒它)"""
+    if data_queue.put_nowait(parts):
+        return True
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, data_queue.put, parts)
+
+
+class IdleWatchdog:
+    """逐包空闲超时 (不依赖 3.11 才有的 asyncio.timeout)
+
+    每包只顺延截止时间；定时器到点时若截止时间已被顺延就改挂到新的截止时间，
+    真正超时才取消当前任务，由调用方把 CancelledError 换成 TimeoutError。
+    """
+
+    def __init__(self, timeout):
+        self.timeout = timeout
+        self.loop = asyncio.get_running_loop()
+        self.task = asyncio.current_task()
+        self.deadline = self.loop.time() + timeout
+        self.expired = False
+        self.handle = self.loop.call_at(self.deadline, self._check)
+
+    def feed(self):
+        self.deadline = self.loop.time() + self.timeout
+
+    def _check(self):
+        if self.loop.time() < self.deadline:
+            self.handle = self.loop.call_at(self.deadline, self._check)
+            return
+        self.expired = True
+        self.task.cancel()
+
+    def cancel(self):
+        self.handle.cancel()
+
+    def uncancel(self):
+        """超时已转成 TimeoutError，撤销计入任务的取消请求 (3.11+ 才有计数)"""
+        if hasattr(self.task, "uncancel"):
+            self.task.uncancel()
+
+
+async def _stream_segment(text, seg_queue, first_audio):
+    """单段下载：整段在一个协程内 async for 收完，音频放入该段私有队列，返回字节数"""
+    conn_start_time = time.time() # 记录连接开始时间
+    chunk_size_total = 0
+    is_first_chunk = True # 标记是否为首包
+
+    # edge-tts 的 receive_timeout 在 WebSocket 握手后就被 aiohttp 清掉了，
+    # 收流阶段的空闲超时由下面的逐包截止时间负责 (不对整段设总时限)
+    communicate = load_edge_tts().Communicate(
+        text, VOICE, rate=RATE, connect_timeout=10, receive_timeout=10
+    )
+    stream = communicate.stream()
+    # 热循环里用到的方法先绑定成局部变量
+    stopped = stop_event.is_set
+    put_audio = seg_queue.put_nowait
+    set_first = first_audio.set
+    # 每收到一包就把截止时间顺延：RECEIVE_IDLE_TIMEOUT 秒无数据即抛 TimeoutError 重试
+    watchdog = IdleWatchdog(RECEIVE_IDLE_TIMEOUT)
+    feed = watchdog.feed
+    try:
+        try:
+            async for chunk in stream:
+                feed()
+                if stopped(): break
+
+                # 记录首包到达时间 (TTFB)
+                if is_first_chunk:
+                    ttfb = time.time() - conn_start_time
+                    log(f"微软服务器已响应 (首包耗时/TTFB: {ttfb:.2f}s)", "NET")
+                    is_first_chunk = False
+
+                # 只有音频包带 "data"，一次查找即可分流
+                data = chunk.get("data")
+                if data is not None:
+                    put_audio(data)
+                    chunk_size_total += len(data)
+                    set_first()
+                elif chunk.get("type") == "error":
+                    raise Exception(f"TTS Error: {chunk.get('message')}")
+        finally:
+            watchdog.cancel()
+            await stream.aclose()
+    except asyncio.CancelledError:
+        if not watchdog.expired:
+            raise
+        watchdog.uncancel()
+        raise asyncio.TimeoutError() from None
+
+    return chunk_size_total
+
+
+async def _download_segment(i, total_chunks, chunk_text, seg_queue, first_audio):
+    """下载单段 (含重试)，结束时向段队列放入 None"""
+    max_retries = 3
+    timeout_retried = False
+    try:
+        for attempt in range(max_retries):
+            try:
+                start_time = time.time()
+                log(f"-> 开始下载第 {i+1}/{total_chunks} 段 ({len(chunk_text)} 字符)...", "NET")
+                
+                chunk_size_total = await _stream_segment(chunk_text, seg_queue, first_audio)
+                
+                duration = time.time() - start_time
+                log(f"<- 第 {i+1} 段下载完成 ({chunk_size_total/1024:.1f} KB, 耗时 {duration:.2f}s)", "NET")
+                break 
+                
+            except Exception as e:
+                if stop_event.is_set(): break
+                
+                # 缺依赖/参数非法/运行环境不兼容，重试也不会好，直接放弃本段
+                if isinstance(e, (ImportError, ValueError, AttributeError, TypeError)):
+                    log(f"!! 第 {i+1} 段下载失败 (不可重试): {e}", "ERR")
+                    break
+                
+                if isinstance(e, asyncio.TimeoutError):
+                    e = f"Network Timeout ({RECEIVE_IDLE_TIMEOUT}s)"
+                    # 偶发超时立即重试一次，其余错误 (限流/服务端异常) 指数退避
+                    delay = 0 if not timeout_retried else retry_delay(attempt)
+                    timeout_retried = True
+                else:
+                    delay = retry_delay(attempt)
+                
+                if attempt < max_retries - 1:
+                    log(f"!! 网络连接失败: {e}. {delay:.1f}s后重试 ({attempt+1}/{max_retries})", "WARN")
+                    await asyncio.sleep(delay)
+                else:
+                    log(f"!! 第 {i+1} 段下载最终失败: {e}", "ERR")
     finally:
+        first_audio.set() # 失败也要放行下一段
+        seg_queue.put_nowait(None)
+
+
+async def _produce_segments(text_chunks, data_queue):
+    """按顺序合并各段音频写入 data_queue
+
+    第 N 段出首包后即开始下载第 N+1 段，用播放时间掩盖下一段的握手延迟；
+    窗口内最多 PREFETCH_SEGMENTS 段 (正在合并的一段 + 预取)，控制内存占用。
+    """
+    total_chunks = len(text_chunks)
+    seg_queues = [asyncio.Queue() for _ in text_chunks]
+    window = asyncio.Semaphore(PREFETCH_SEGMENTS)
+    tasks = []
+
+    async def launch():
         try:
-            if loop.is_running(): loop.stop()
-            if not loop.is_closed():
-                loop.run_until_complete(loop.shutdown_asyncgens())
-                loop.run_until_complete(asyncio.sleep(0.250)) 
-                loop.close()
-        except: pass
+            for i, chunk_text in enumerate(text_chunks):
+                await window.acquire()
+                if stop_event.is_set(): break
+                first_audio = asyncio.Event()
+                tasks.append(asyncio.create_task(
+                    _download_segment(i, total_chunks, chunk_text, seg_queues[i], first_audio)
+                ))
+                await first_audio.wait()
+        finally:
+            # 未启动的段直接结束，避免合并端空等
+            for q in seg_queues[len(tasks):]:
+                q.put_nowait(None)
+
+    launcher = asyncio.create_task(launch())
+    pending = [] # 待交付的小包 (只存引用，交付时各自拷入环形缓冲)
+    pending_size = 0
+    try:
+        for seg_queue in seg_queues:
+            while True:
+                if pending and seg_queue.empty():
+                    # 暂无后续数据，先交付已攒的部分，不拖慢首响
+                    if not await _queue_put_async(data_queue, pending):
+                        return
+                    pending = []
+                    pending_size = 0
+                data = await seg_queue.get()
+                if data is None:
+                    break
+                if stop_event.is_set(): return
+                pending.append(data)
+                pending_size += len(data)
+                if pending_size >= PENDING_TARGET:
+                    if not await _queue_put_async(data_queue, pending):
+                        return
+                    pending = []
+                    pending_size = 0
+            window.release()
+        if pending:
+            await _queue_put_async(data_queue, pending)
+    finally:
+        launcher.cancel()
+        for task in tasks:
+            task.cancel()
+
+
+async def audio_producer(text_chunks, data_queue):
+    """生产者 (完整日志版)，作为任务直接运行在常驻事件循环上"""
+    total_chunks = len(text_chunks)
+    log(f"下载任务启动 (任务队列: {total_chunks})", "NET")
+    
+    try:
+        await _produce_segments(text_chunks, data_queue)
+    except Exception as e:
+        log(f"生产者任务崩溃: {e}", "FATAL")
+        traceback.print_exc()
+    finally:
+        data_queue.close()
+        log("生产者任务退出", "NET")
+
+
+def open_ffplay_pipe():
+    """创建 ffplay 的 stdin 管道并放大内核缓冲，返回 (读端 fd, 写端 fd)"""
+    if kernel32:
+        read_handle = ctypes.c_void_p()
+        write_handle = ctypes.c_void_p()
+        if kernel32.CreatePipe(
+            ctypes.byref(read_handle), ctypes.byref(write_handle), None, PIPE_BUFFER_SIZE
+        ):
+            return (msvcrt.open_osfhandle(read_handle.value, os.O_RDONLY),
+                    msvcrt.open_osfhandle(write_handle.value, 0))
+        log(f"CreatePipe 失败 (err={ctypes.get_last_error()})，使用默认管道", "WARN")
+        return os.pipe()
+
+    read_fd, write_fd = os.pipe()
+    if hasattr(fcntl, "F_SETPIPE_SZ"): # 仅 Linux
         try:
-            data_queue.put(None, timeout=2)
-        except: pass
-        log("生产者线程退出", "NET")
+            fcntl.fcntl(write_fd, fcntl.F_SETPIPE_SZ, PIPE_BUFFER_SIZE)
+        except OSError: pass
+    return read_fd, write_fd
+
+
+def watch_player(proc, data_queue):
+    """播放器退出时中止缓冲区，唤醒阻塞中的消费者 (取代轮询 poll)"""
+    proc.wait()
+    data_queue.abort()
+
+
+def write_views(fd, views, ring):
+    """把 peek 借出的数据直写管道，写出多少就归还多少；返回总字节数
+
+    os.write 绕过 BufferedWriter 的锁和拷贝；POSIX 上回绕的两段用 writev 一次写出
+    """
+    views = list(views)
+    total = 0
+    while views:
+        if len(views) > 1 and HAS_WRITEV:
+            n = os.writev(fd, views)
+        else:
+            n = os.write(fd, views[0])
+        ring.release(n)
+        total += n
+        # 丢掉已写完的部分 (处理部分写入)
+        while n:
+            size = len(views[0])
+            if n >= size:
+                n -= size
+                views.pop(0)
+            else:
+                views[0] = views[0][n:]
+                n = 0
+    return total
 
 
 def play_clipboard():
     """消费者 (极速响应版)"""
-    global is_playing, ffplay_process, start_press_time
+    global ffplay_process, active_queue, last_split
     
     text = None
     text_chunks = None
     data_queue = None
-    producer_thread = None
+    producer = None
+    proc = None
     
     try:
         text = pyperclip.paste()
         if not text or not text.strip():
             log("剪贴板内容为空", "WARN")
-            with lock: is_playing = False
+            stop_event.set()
             return
             
         preview = text[:30].replace('\n', ' ')
@@ -267,105 +825,96 @@ def play_clipboard():
         
         stop_playback(clear_flags=False)
         
-        text_chunks = split_text_smart_v3(text)
+        # 反复朗读同一段剪贴板时直接复用分块结果 (分块列表只读，可安全共享)
+        if text == last_split[0]:
+            text_chunks = last_split[1]
+            log("剪贴板未变化，复用上次分块", "TEXT")
+        else:
+            text_chunks = split_text_smart_v3(text)
+            last_split = (text, text_chunks)
         if not text_chunks:
-            with lock: is_playing = False
+            stop_event.set()
             return
         
         log(f"文本分块完成: 共 {len(text_chunks)} 块", "TEXT")
 
         # [Final Check] 启动前最后确认
+        if stop_event.is_set():
+            log("检测到停止信号，取消启动", "INFO")
+            return
+
+        # 先启动下载：握手/首包的网络等待与下面的 ffplay 进程启动重叠
+        data_queue = SPSCBytesRing(AUDIO_BUFFER_SIZE)
         with lock:
-            if not is_playing:
-                log("检测到停止信号，取消启动", "INFO")
-                return
+            active_queue = data_queue
+        producer = asyncio.run_coroutine_threadsafe(
+            audio_producer(text_chunks, data_queue), tts_loop
+        )
 
-        creationflags = subprocess.CREATE_NO_WINDOW if sys.platform == "win32" else 0
+        read_fd, stdin_fd = open_ffplay_pipe()
         
-        # === 极速启动参数 ===
-        # -fflags nobuffer: 禁用输入缓冲
-        # -flags low_delay: 启用低延迟模式
-        proc = subprocess.Popen([
-            get_ffplay_path(), "-nodisp", "-autoexit", 
-            "-fflags", "nobuffer", 
-            "-flags", "low_delay",
-            "-strict", "experimental",
-            "-i", "pipe:0",
-            "-af", f"atempo={SPEED}" if SPEED < 2.0 else "atempo=2.0,atempo={{SPEED/2}}",
-            "-probesize", "4096", "-analyzeduration", "0", 
-            "-loglevel", "error"
-        ], stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=sys.stderr, creationflags=creationflags)
+        try:
+            proc = subprocess.Popen(FFPLAY_ARGV, stdin=read_fd,
+                                    stdout=subprocess.DEVNULL, stderr=sys.stderr,
+                                    **FFPLAY_POPEN_KWARGS)
+        except:
+            os.close(stdin_fd)
+            raise
+        finally:
+            os.close(read_fd)
+        proc.stdin = open(stdin_fd, "wb", buffering=0)
         
+        assign_to_ffplay_job(proc)
         with lock:
             ffplay_process = proc
         
         log(f"播放器进程已挂载 (PID: {proc.pid})", "PROC")
-
-        data_queue = queue.Queue(maxsize=100)
-        producer_thread = threading.Thread(
-            target=audio_producer, 
-            args=(text_chunks, data_queue), 
-            daemon=True
-        )
-        producer_thread.start()
+        threading.Thread(target=watch_player, args=(proc, data_queue), daemon=True).start()
         
         log("等待数据流...", "INFO")
         byte_count = 0
         chunk_idx = 0
         first_byte_time = None
         
+        # 阻塞读取，无轮询：数据 / EOF (None) / 中止 (停止播放或播放器退出) 都会唤醒
         while True:
-            with lock:
-                if not is_playing: break
-                current_proc = ffplay_process
-            
-            if current_proc and current_proc.poll() is not None:
-                log(f"播放器意外退出 (Exit Code: {current_proc.returncode})", "ERR")
+            chunk_data = data_queue.peek()
+            if chunk_data is None:
+                log("收到 EOF 结束信号", "INFO")
                 break
-                
+            if chunk_data is STOP_SENTINEL:
+                if not stop_event.is_set() and proc.poll() is not None:
+                    log(f"播放器意外退出 (Exit Code: {proc.returncode})", "ERR")
+                break
+            
             try:
-                chunk_data = data_queue.get(timeout=0.5)
-                if chunk_data is None:
-                    log("收到 EOF 结束信号", "INFO")
-                    break
+                # 直接从环形区写出，写完即归还给生产者
+                byte_count += write_views(stdin_fd, chunk_data, data_queue)
+                chunk_idx += 1
                 
-                try:
-                    current_proc.stdin.write(chunk_data)
-                    byte_count += len(chunk_data)
-                    chunk_idx += 1
-                    
-                    # === 延迟统计 ===
-                    if first_byte_time is None:
-                        first_byte_time = datetime.datetime.now()
-                        latency = 0
-                        if start_press_time:
-                            latency = time.time() - start_press_time
-                        log(f"⚡ 首响延迟: {latency:.2f}秒 (声音开始)", "PERF")
-                    
-                    if chunk_idx % 10 == 0:
-                        log(f"播放中... 已写入 {chunk_idx} 包 ({byte_count/1024:.1f} KB)", "PLAY")
-                        
-                except Exception as e:
-                    log(f"写入管道失败: {e}", "ERR")
-                    break
+                # === 延迟统计 ===
+                if first_byte_time is None:
+                    first_byte_time = time.time()
+                    latency = 0
+                    if start_press_time:
+                        latency = time.time() - start_press_time
+                    log(f"⚡ 首响延迟: {latency:.2f}秒 (声音开始)", "PERF")
+                
+                if chunk_idx % 10 == 0:
+                    log(f"播放中... 已写入 {chunk_idx} 包 ({byte_count/1024:.1f} KB)", "PLAY")
                     
-            except queue.Empty:
-                if not producer_thread.is_alive():
-                    log("数据源已耗尽", "INFO")
-                    break
-                log("缓冲中... (Waiting for Net)", "WARN")
-                continue
+            except Exception as e:
+                log(f"写入管道失败: {e}", "ERR")
+                break
 
         log(f"播放结束 (总流量: {byte_count/1024:.2f} KB)", "INFO")
         
-        with lock:
-            current_proc = ffplay_process
-            still_playing = is_playing
-        
-        if current_proc and still_playing:
+        if not stop_event.is_set():
+            # 管道里可能还有数秒到数分钟的音频，等 ffplay 播完自行退出；
+            # 用户中途停止时 stop_playback 会结束进程，wait 随之返回
             try:
-                current_proc.stdin.close()
-                current_proc.wait(timeout=3)
+                proc.stdin.close()
+                proc.wait()
             except: pass
 
     except Exception as e:
@@ -374,47 +923,63 @@ def play_clipboard():
     finally:
         log("开始资源回收...", "CLEAN")
         stop_playback()
+        if producer:
+            producer.cancel() # 可能仍卡在网络等待上，直接取消
+        if proc:
+            try:
+                proc.stdin.close()
+            except: pass
         
         if data_queue:
-            with data_queue.mutex: data_queue.queue.clear()
-        
-        del text, text_chunks, data_queue, producer_thread
-        gc.collect()
+            data_queue.clear()
         
         log_memory_stats()
         log("会话结束", "INFO")
 
 
 def on_hotkey():
-    global is_playing, start_press_time
+    global start_press_time
     
-    with lock: playing = is_playing
-    
-    if playing:
+    if not stop_event.is_set():
         log(">> 用户触发停止 <<", "USER")
         threading.Thread(target=stop_playback, daemon=True).start()
     else:
         # 记录按下时间
         start_press_time = time.time()
         log(">> 用户触发朗读 <<", "USER")
-        with lock: is_playing = True
+        stop_event.clear()
         threading.Thread(target=play_clipboard, daemon=True).start()
 
 
 def main():
-    if not check_singleton():
+    global ffplay_job, tts_loop, HOTKEY
+    singleton = check_singleton() # 持有句柄直到退出，释放即解除单例锁
+    if not singleton:
         print("!! 程序已在运行中 !!")
         sys.exit(0)
 
-    keyboard.add_hotkey('alt+c', on_hotkey)
+    ffplay_job = create_ffplay_job()
+    tts_loop = start_tts_loop()
+    # 下载协程都跑在该循环上，导入排在最前面，首次朗读时必然已完成
+    tts_loop.call_soon_threadsafe(warm_up_edge_tts)
+    asyncio.run_coroutine_threadsafe(warm_up_dns(), tts_loop)
+    try:
+        keyboard.add_hotkey(HOTKEY, on_hotkey)
+    except ValueError as e:
+        # 无控制台的 exe 里崩溃没人看得到，非法快捷键回退默认值
+        log(f"快捷键 {HOTKEY!r} 无效 ({e})，使用默认值 {DEFAULT_HOTKEY}", "WARN")
+        HOTKEY = DEFAULT_HOTKEY
+        keyboard.add_hotkey(HOTKEY, on_hotkey)
     
     log(f"=== ClipSpeak Pro (Low Latency) ===", "INIT")
     log(f"PID={os.getpid()} | Python {sys.version.split()[0]}", "INIT")
+    log(f"快捷键: {HOTKEY} | 语速: {RATE} x {SPEED}", "INIT")
     
     try:
         keyboard.wait()
     except KeyboardInterrupt:
         stop_playback()
+        stop_tts_loop(tts_loop)
 
 if __name__ == "__main__":
     main()